@@ -19,9 +19,15 @@
 # Instance prerequisites:
 # python3 -m pip install pip -U --user
 # python3 -m pip install wheel oci requests -U --user
+# Optionally, for faster metadata parsing:
+# python3 -m pip install orjson -U --user
 # 
 # Usage:
 # python3 ./OCI_Self-Terminate.py
+# To exit as soon as the termination is requested, without waiting for the TERMINATING state:
+# OCI_SELFTERMINATE_NOWAIT=1 python3 ./OCI_Self-Terminate.py
+# To also capture the OCI SDK and urllib3 debug output in the log file (default level is INFO):
+# OCI_SELFTERMINATE_LOGLEVEL=DEBUG python3 ./OCI_Self-Terminate.py
 # 
 # Disclaimer: 
 # This script is an independent tool developed by 
@@ -32,133 +38,212 @@
 
 version="1.0.1"
 
+import os
 import sys
-import oci
+import time
+import contextlib
+import queue
 import requests
 import logging
-from datetime import datetime
+import logging.handlers
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional, fall back to the stdlib parser when it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# reuse a single keep-alive connection to the metadata endpoint
+# IMDS only speaks plain HTTP/1.1, and the OCI signer manages its own transport internally
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    # only 5xx responses are retried here, timeouts are retried by get_instance_metadata
+    # connect=0 surfaces as requests.ConnectTimeout, read=False as requests.ReadTimeout
+    max_retries=Retry(total=5, connect=0, read=False, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    ))
+
+# instance identity never changes for the VM lifetime, keep the first successful response
+_METADATA_CACHE = {}
+
+# metadata fields logged by log_instance_details, raises KeyError if any is missing
+_INSTANCE_FIELDS = itemgetter(
+    "canonicalRegionName",
+    "availabilityDomain",
+    "faultDomain",
+    "displayName",
+    "id",
+    "shape"
+    )
 
 def print_log_content(log_file):
 
     print("\nLog file content:\n")
     try:
-        with open(log_file, 'r') as f:
-            print(f.read())
+        # only the last 8 KB are printed, retries can make the log grow large
+        with open(log_file, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(0, size - 8192))
+            sys.stdout.flush()
+            sys.stdout.buffer.write(f.read())
+            sys.stdout.buffer.flush()
     except FileNotFoundError:
         print(f"Error: The file '{log_file}' does not exist.")
     except Exception as e:
         print(f"An error occurred: {e}")
 
-def get_instance_metadata(log_file):
-
-    url = "http://169.254.169.254/opc/v2/instance/"
-    headers = {"Authorization": "Bearer Oracle"}
+@contextlib.contextmanager
+def log_tail(log_file, listener):
 
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-    except requests.RequestException as e:
-        logging.error(f"Failed to fetch instance metadata: {e}")
+        yield
+    finally:
+        # drain the queued records to the file before printing it
+        listener.stop()
         print_log_content(log_file)
-        sys.exit(1)
 
-    return response.json()
+def get_instance_metadata():
+
+    if "data" in _METADATA_CACHE:
+        return _METADATA_CACHE["data"]
+
+    url = "http://169.254.169.254/opc/v2/instance/"
+    headers = {"Authorization": "Bearer Oracle"}
+
+    # bounded connect/read timeouts, a slow IMDS would otherwise hang on the OS TCP defaults
+    for attempt in range(3):
+        try:
+            response = _SESSION.get(url, headers=headers, timeout=(1.0, 3.0))
+            response.raise_for_status()
+            break
+        except requests.Timeout as e:
+            logging.warning("Instance metadata request timed out (attempt %s/3): %s", attempt + 1, e)
+            if attempt == 2:
+                logging.error("Failed to fetch instance metadata: %s", e)
+                raise SystemExit(1)
+            time.sleep(0.2 * 2**attempt)
+        except requests.RequestException as e:
+            logging.error("Failed to fetch instance metadata: %s", e)
+            raise SystemExit(1)
+
+    _METADATA_CACHE["data"] = orjson.loads(response.content) if orjson else response.json()
+    return _METADATA_CACHE["data"]
 
 def log_instance_details(data):
 
-    logging.info(f'Instance_Region: {data["canonicalRegionName"]}')
-    logging.info(f'Instance_AD: {data["availabilityDomain"]}')
-    logging.info(f'Instance_FD: {data["faultDomain"]}')
-    logging.info(f'Instance_Name: {data["displayName"]}')
-    logging.info(f'Instance_ID: {data["id"]}')
-    logging.info(f'Instance_Shape: {data["shape"]}')
+    logging.info(
+        "Instance_Region: %s\n"
+        "Instance_AD: %s\n"
+        "Instance_FD: %s\n"
+        "Instance_Name: %s\n"
+        "Instance_ID: %s\n"
+        "Instance_Shape: %s",
+        *_INSTANCE_FIELDS(data)
+        )
 
-def terminate_instance(core_client, instance_id, custom_retry_strategy, log_file):
+def terminate_instance(core_client, instance_id, retry_strategy):
 
     try:
         core_client.terminate_instance(
             instance_id=instance_id,
             preserve_boot_volume=False, # /!\ 'False' terminates the Boot Volume otherwise use 'True'
             preserve_data_volumes_created_at_launch=False, # /!\ 'False' terminates the attached Block Volumes created during instance launch otherwise use 'True'
-            retry_strategy=custom_retry_strategy)
+            retry_strategy=retry_strategy)
         
-        logging.info(f'Instance termination requested')
+        logging.info("Instance termination requested")
         return
 
     except Exception as e:
-        logging.error(f"Failed to terminate instance: {e}")
-        print_log_content(log_file)
-        sys.exit(1)
+        logging.error("Failed to terminate instance: %s", e)
+        raise SystemExit(1)
 
 def main():
     
     # set log file in ./migration_YYYY-MM-DD_HH-mm.log for debugging
-    now=datetime.now().strftime("%Y-%m-%d_%H-%M")
+    now=time.strftime("%Y-%m-%d_%H-%M")
     log_file=f'inst_termination{now}.log'
 
-    logging.basicConfig(
-        filename=log_file,
-        level=logging.DEBUG,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+    # records are queued and written to the log file by a background listener thread
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter(
+        fmt='%(asctime)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        ))
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+
+    # INFO by default, OCI_SELFTERMINATE_LOGLEVEL=DEBUG also captures the OCI SDK and urllib3 debug output
+    log_level = os.getenv("OCI_SELFTERMINATE_LOGLEVEL", "INFO").upper()
+    if log_level not in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"):
+        log_level = "INFO"
+
+    root_logger = logging.getLogger()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(log_level)
     
-    custom_retry_strategy = oci.retry.RetryStrategyBuilder(
-        max_attempts_check=True,
-        max_attempts=8,
-        total_elapsed_time_check=True,
-        total_elapsed_time_seconds=600,
-        retry_max_wait_between_calls_seconds=15,
-        retry_base_sleep_time_seconds=15,
-    ).get_retry_strategy()
-
-    signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner(retry_strategy=custom_retry_strategy)
-    config = {'region': signer.region, 'tenancy': signer.tenancy_id}
-
-    logging.info("Fetching instance metadata...")
-    instance_data = get_instance_metadata(log_file)
-
-    if instance_data:
-        log_instance_details(instance_data)
-        instance_id = instance_data.get("id")
-        if not instance_id:
-            logging.error("Instance ID not found in metadata.\n")
-            print_log_content(log_file)
-            sys.exit(1)
+    # the session is closed and the log tail printed however the script exits
+    with _SESSION, log_tail(log_file, listener):
+        logging.info("Fetching instance metadata...")
+        instance_data = get_instance_metadata()
+        if not instance_data:
+            logging.error("Failed to fetch instance metadata.")
+            raise SystemExit(1)
+
+        try:
+            log_instance_details(instance_data)
+        except KeyError as e:
+            logging.error("Field %s not found in metadata.", e)
+            raise SystemExit(1)
+        instance_id = instance_data["id"]
+
+        # the OCI SDK is slow to import, only load it once the metadata is available
+        import oci
+
+        retry_strategy = oci.retry.DEFAULT_RETRY_STRATEGY
+
+        signer = oci.auth.signers.InstancePrincipalsSecurityTokenSigner(retry_strategy=retry_strategy)
+        config = {'region': signer.region, 'tenancy': signer.tenancy_id}
 
         core_client = oci.core.ComputeClient(config=config, signer=signer)
 
         logging.info("Starting instance termination...")
-        terminate_instance(core_client, instance_id, custom_retry_strategy, log_file)
-        
+        terminate_instance(core_client, instance_id, retry_strategy)
+
+        # the termination is accepted at this point, watching the lifecycle state is optional
+        if os.getenv("OCI_SELFTERMINATE_NOWAIT", "").lower() in ("1", "true", "yes"):
+            logging.info("Not waiting for TERMINATING state")
+            raise SystemExit(0)
+    
         try:
             wait_termination = oci.wait_until(
                 core_client,
                 core_client.get_instance(instance_id),
                 'lifecycle_state',
                 'TERMINATING',
-                max_wait_seconds=600
+                max_wait_seconds=600,
+                max_interval_seconds=2,
+                succeed_on_not_found=True
             )
+            if wait_termination is oci.waiter.WAIT_RESOURCE_NOT_FOUND:
+                logging.info("Instance termination succeeded")
+                raise SystemExit(0)
+
             if wait_termination.data.lifecycle_state == "TERMINATING":
-                logging.info(f'Instance_State: {wait_termination.data.lifecycle_state}')
-                print_log_content(log_file)
-                sys.exit(0)
+                logging.info("Instance_State: %s", wait_termination.data.lifecycle_state)
+                raise SystemExit(0)
 
         except Exception as e:
-            required_attributes = ["target_service", "status", "code", "message", "operation_name"]
-            if all(hasattr(e, attr) for attr in required_attributes):
-                 if (e.target_service == "compute" and e.status == 404 and e.code == "NotAuthorizedOrNotFound" and "not found" in e.message and e.operation_name == "get_instance"):
-                    logging.info("Instance termination succeeded")
-                    print_log_content(log_file)
-                    sys.exit(0)
-            else:
-                logging.error(f"Instance Termination failed: {e}")
-                print_log_content(log_file)
-                sys.exit(1)
-    else:
-        logging.error("Failed to fetch instance metadata.")
-        print_log_content(log_file)
-        sys.exit(1)
+            if (isinstance(e, oci.exceptions.ServiceError) and e.status == 404 and e.code == "NotAuthorizedOrNotFound" and e.operation_name == "get_instance"):
+                logging.info("Instance termination succeeded")
+                raise SystemExit(0)
+            logging.error("Instance Termination failed: %s", e)
+            raise SystemExit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file